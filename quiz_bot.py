@@ -10,11 +10,12 @@ Delivers Moodle quiz content through Matrix chat interface
 """
 
 import asyncio
-import json
 import logging
-from typing import Dict, List, Optional
-from dataclasses import dataclass, asdict
-from datetime import datetime
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, asdict, field
 
 # Matrix SDK
 from nio import AsyncClient, MatrixRoom, RoomMessageText
@@ -22,6 +23,13 @@ from nio.events import Event
 
 # HTTP requests for Moodle API
 import aiohttp
+import orjson
+
+# Faster event loop where available (not supported on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configuration
 from dotenv import load_dotenv
@@ -37,6 +45,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Most quizzes whose questions are kept in memory; ids come from user input
+_QUESTIONS_CACHE_SIZE = 64
+
+# Attempts at submitting a completed quiz before giving up
+_SUBMIT_ATTEMPTS = 3
+
+# Greeting words that trigger the introduction message
+_GREETING_RE = re.compile(r'\b(?:hello|hi|hey)\b', re.IGNORECASE)
+
+# Accepted answers to a multiple choice question, in either case
+_VALID_ANSWERS = frozenset('ABCDabcd')
+
+# Plain text to Matrix HTML in a single pass: escape markup, keep line breaks
+_HTML_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '\n': '<br/>',
+})
+
+def _to_html(text: str) -> str:
+    """Render plain message text as a Matrix HTML body"""
+    return text.translate(_HTML_TABLE)
+
+# Static bot responses, rendered to HTML once at import time
+_QUIZ_HELP_PLAIN = (
+    "📚 Quiz Bot Commands:\n"
+    "• `!quiz list` - Show available quizzes\n"
+    "• `!quiz start <quiz_id>` - Start a quiz\n"
+    "• `!help` - Get help from teacher"
+)
+_QUIZ_HELP_HTML = _to_html(_QUIZ_HELP_PLAIN)
+
+# For demo, show sample quizzes
+_QUIZ_LIST_PLAIN = (
+    "📚 **Available Quizzes:**\n\n"
+    "🔢 `quiz_math_1` - Basic Math Chapter 1\n"
+    "🔠 `quiz_english_1` - Grammar Basics\n"
+    "🧪 `quiz_science_1` - Introduction to Physics\n\n"
+    "To start a quiz, type: `!quiz start quiz_math_1`"
+)
+_QUIZ_LIST_HTML = _to_html(_QUIZ_LIST_PLAIN)
+
+_HELP_REQUEST_PLAIN = (
+    "🆘 **Help Request Sent!**\n\n"
+    "Your teacher has been notified and will join this room shortly.\n"
+    "In the meantime, you can:\n"
+    "• Continue with the quiz\n"
+    "• Review the question carefully\n"
+    "• Think about what you already know about this topic"
+)
+_HELP_REQUEST_HTML = _to_html(_HELP_REQUEST_PLAIN)
+
+_GREETING_PLAIN = (
+    "👋 Hello! I'm the Quiz Bot.\n\n"
+    "📚 Type `!quiz` to see available commands\n"
+    "🆘 Type `help` if you need assistance"
+)
+_GREETING_HTML = _to_html(_GREETING_PLAIN)
+
 @dataclass
 class QuizSession:
     """Active quiz session state"""
@@ -44,14 +112,12 @@ class QuizSession:
     student_id: str
     quiz_id: str
     current_question: int = 0
-    answers: Dict[str, str] = None
-    started_at: datetime = None
-    
-    def __post_init__(self):
-        if self.answers is None:
-            self.answers = {}
-        if self.started_at is None:
-            self.started_at = datetime.now()
+    answers: Dict[str, str] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.monotonic)
+    last_active: float = field(default_factory=time.monotonic)
+    questions: List['QuizQuestion'] = None
+    rendered: List[Tuple[str, str]] = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False, compare=False)
 
 @dataclass
 class QuizQuestion:
@@ -61,6 +127,11 @@ class QuizQuestion:
     options: List[str]
     question_type: str
     order: int
+    options_text: str = field(init=False, default='')
+    
+    def __post_init__(self):
+        # Options never change, so join them for display only once
+        self.options_text = '\n'.join(self.options)
 
 class MoodleClient:
     """Interface to Moodle Web Services API"""
@@ -69,9 +140,26 @@ class MoodleClient:
         self.server_url = server_url.rstrip('/')
         self.api_token = api_token
         self.session = None
+        
+        # Parts of every API request that never change
+        self._url = f"{self.server_url}/webservice/rest/server.php"
+        self._base_params = {
+            'wstoken': api_token,
+            'moodlewsrestformat': 'json'
+        }
     
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        # Bound concurrent connections so many simultaneous quizzes
+        # cannot exhaust sockets or overload the Moodle server
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=50,
+                limit_per_host=20,
+                keepalive_timeout=75,
+                ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=30, connect=5)
+        )
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -80,17 +168,10 @@ class MoodleClient:
     
     async def api_call(self, function: str, params: Dict) -> Dict:
         """Make Moodle Web Services API call"""
-        url = f"{self.server_url}/webservice/rest/server.php"
-        
-        data = {
-            'wstoken': self.api_token,
-            'wsfunction': function,
-            'moodlewsrestformat': 'json',
-            **params
-        }
+        data = {**self._base_params, 'wsfunction': function, **params}
         
-        async with self.session.post(url, data=data) as response:
-            result = await response.json()
+        async with self.session.post(self._url, data=data) as response:
+            result = orjson.loads(await response.read())
             
             if isinstance(result, dict) and 'exception' in result:
                 raise Exception(f"Moodle API Error: {result['message']}")
@@ -122,7 +203,7 @@ class MoodleClient:
     async def submit_quiz_attempt(self, quiz_id: str, user_id: str, answers: Dict) -> Dict:
         """Submit completed quiz attempt"""
         # Implementation would submit to Moodle's quiz API
-        logger.info(f"Submitting quiz {quiz_id} for user {user_id}: {answers}")
+        logger.info("Submitting quiz %s for user %s: %s", quiz_id, user_id, answers)
         return {"success": True, "attempt_id": "12345"}
 
 class QuizBot:
@@ -138,12 +219,45 @@ class QuizBot:
         self.moodle_server = os.getenv('MOODLE_SERVER', 'https://gs.teebase.net')
         self.moodle_token = os.getenv('MOODLE_API_TOKEN')
         
+        # Seconds of inactivity before an abandoned quiz session is dropped
+        idle_timeout = os.getenv('QUIZ_SESSION_IDLE_TIMEOUT', '7200')
+        try:
+            self.session_idle_timeout = int(idle_timeout)
+        except ValueError:
+            self.session_idle_timeout = 0
+        if self.session_idle_timeout <= 0:
+            logger.warning("Invalid QUIZ_SESSION_IDLE_TIMEOUT %r, using 7200 seconds", idle_timeout)
+            self.session_idle_timeout = 7200
+        
         # Bot state
         self.client: Optional[AsyncClient] = None
         self.moodle: Optional[MoodleClient] = None
-        self.active_sessions: Dict[str, QuizSession] = {}
+        # Ordered from least to most recently active
+        self.active_sessions: 'OrderedDict[str, QuizSession]' = OrderedDict()
+        self._gc_task: Optional[asyncio.Task] = None
+        # (questions, rendered questions) per quiz, least recently used first
+        self._questions_cache: 'OrderedDict[str, Tuple[List[QuizQuestion], List[Tuple[str, str]]]]' = OrderedDict()
+        
+        # Outbound message content templates, copied for every send
+        self._msg_template_plain = {
+            "msgtype": "m.text",
+            "body": ""
+        }
+        self._msg_template_html = {
+            "msgtype": "m.text",
+            "body": "",
+            "format": "org.matrix.custom.html",
+            "formatted_body": ""
+        }
+        
+        # Command dispatch table, keyed by the lowercased first word
+        self._commands = {
+            '!quiz': self.handle_quiz_command,
+            'help': self.handle_help_request,
+            '!help': self.handle_help_request,
+        }
         
-        logger.info(f"Quiz Bot initialized for {self.homeserver}")
+        logger.info("Quiz Bot initialized for %s", self.homeserver)
     
     async def start(self):
         """Start the bot"""
@@ -160,47 +274,86 @@ class QuizBot:
         if hasattr(response, 'access_token'):
             logger.info("Successfully logged into Matrix")
         else:
-            logger.error(f"Failed to login: {response}")
+            logger.error("Failed to login: %s", response)
             return
         
-        # Initialize Moodle client
+        # Initialize Moodle client (one HTTP session shared by all handlers)
         self.moodle = MoodleClient(self.moodle_server, self.moodle_token)
+        await self.moodle.__aenter__()
+        
+        # Periodically drop abandoned quiz sessions
+        self._gc_task = asyncio.create_task(self._gc_sessions())
         
         # Start syncing
         await self.client.sync_forever(timeout=30000)
     
+    async def _get_questions(self, quiz_id: str) -> Tuple[List[QuizQuestion], List[Tuple[str, str]]]:
+        """Get quiz questions and their rendered messages, once per quiz"""
+        cached = self._questions_cache.get(quiz_id)
+        if cached is not None:
+            self._questions_cache.move_to_end(quiz_id)
+            return cached
+        
+        questions = await self.moodle.get_quiz_questions(quiz_id)
+        cached = (questions, self.render_questions(questions))
+        
+        # Only cache real quizzes, and evict the least recently used one
+        # once the cache is full
+        if questions:
+            self._questions_cache[quiz_id] = cached
+            if len(self._questions_cache) > _QUESTIONS_CACHE_SIZE:
+                self._questions_cache.popitem(last=False)
+        return cached
+    
+    async def _gc_sessions(self):
+        """Evict quiz sessions that have been idle for too long"""
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            while self.active_sessions:
+                room_id, session = next(iter(self.active_sessions.items()))
+                if now - session.last_active <= self.session_idle_timeout:
+                    break
+                del self.active_sessions[room_id]
+                logger.info("Dropped idle quiz %s in %s", session.quiz_id, room_id)
+    
     async def message_callback(self, room: MatrixRoom, event: Event):
         """Handle incoming Matrix messages"""
         # Ignore messages from the bot itself
         if event.sender == self.client.user_id:
             return
         
-        message_content = event.body.strip().lower()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Message in %s: %s", room.room_id, event.body)
+        
+        # Any message in a quiz room, commands included, keeps its session alive
+        session = self.active_sessions.get(room.room_id)
+        if session:
+            self.active_sessions.move_to_end(room.room_id)
+            session.last_active = time.monotonic()
+        
+        # Strip once and hand the result to every handler
+        stripped = event.body.strip()
         
-        logger.info(f"Message in {room.room_id}: {event.body}")
+        # Only the first word is needed to recognise a command, so avoid
+        # lowercasing the whole (possibly long) body
+        words = stripped[:16].split(None, 1)
+        handler = self._commands.get(words[0].lower()) if words else None
         
-        # Handle quiz commands
-        if message_content.startswith('!quiz'):
-            await self.handle_quiz_command(room, event)
-        elif message_content in ['help', '!help']:
-            await self.handle_help_request(room, event)
+        if handler:
+            await handler(room, event, stripped)
         elif room.room_id in self.active_sessions:
-            await self.handle_quiz_answer(room, event)
+            await self.handle_quiz_answer(room, event, stripped)
         else:
             # General commands
-            await self.handle_general_message(room, event)
+            await self.handle_general_message(room, event, stripped)
     
-    async def handle_quiz_command(self, room: MatrixRoom, event: Event):
+    async def handle_quiz_command(self, room: MatrixRoom, event: Event, stripped: str):
         """Handle !quiz commands"""
-        parts = event.body.split()
+        parts = stripped.split()
         
         if len(parts) < 2:
-            await self.send_message(room, 
-                "📚 Quiz Bot Commands:\n"
-                "• `!quiz list` - Show available quizzes\n"
-                "• `!quiz start <quiz_id>` - Start a quiz\n"
-                "• `!help` - Get help from teacher"
-            )
+            await self.send_prerendered(room, _QUIZ_HELP_PLAIN, _QUIZ_HELP_HTML)
             return
         
         command = parts[1].lower()
@@ -215,15 +368,7 @@ class QuizBot:
     
     async def list_available_quizzes(self, room: MatrixRoom, event: Event):
         """List available quizzes for the student"""
-        # For demo, show sample quizzes
-        message = (
-            "📚 **Available Quizzes:**\n\n"
-            "🔢 `quiz_math_1` - Basic Math Chapter 1\n"
-            "🔠 `quiz_english_1` - Grammar Basics\n"
-            "🧪 `quiz_science_1` - Introduction to Physics\n\n"
-            "To start a quiz, type: `!quiz start quiz_math_1`"
-        )
-        await self.send_message(room, message)
+        await self.send_prerendered(room, _QUIZ_LIST_PLAIN, _QUIZ_LIST_HTML)
     
     async def start_quiz(self, room: MatrixRoom, event: Event, quiz_id: str):
         """Start a new quiz session"""
@@ -233,14 +378,15 @@ class QuizBot:
         
         try:
             # Get quiz questions from Moodle
-            async with MoodleClient(self.moodle_server, self.moodle_token) as moodle:
-                questions = await moodle.get_quiz_questions(quiz_id)
+            questions, rendered = await self._get_questions(quiz_id)
             
             # Create quiz session
             session = QuizSession(
                 room_id=room.room_id,
                 student_id=event.sender,
-                quiz_id=quiz_id
+                quiz_id=quiz_id,
+                questions=questions,
+                rendered=rendered
             )
             
             self.active_sessions[room.room_id] = session
@@ -254,130 +400,161 @@ class QuizBot:
                 "Ready? Here's your first question..."
             )
             
-            await self.send_next_question(room, session, questions)
+            await self.send_next_question(room, session)
             
         except Exception as e:
-            logger.error(f"Error starting quiz: {e}")
+            logger.error("Error starting quiz: %s", e)
             await self.send_message(room, f"❌ Error starting quiz: {e}")
     
-    async def send_next_question(self, room: MatrixRoom, session: QuizSession, questions: List[QuizQuestion]):
+    def render_questions(self, questions: List[QuizQuestion]) -> List[Tuple[str, str]]:
+        """Pre-render (plain, html) message bodies for every question"""
+        rendered = []
+        for index, question in enumerate(questions):
+            message = (
+                f"**Question {index + 1} of {len(questions)}**\n\n"
+                f"❓ {question.text}\n\n"
+                f"{question.options_text}\n\n"
+                "💡 Type your answer (A, B, C, or D)"
+            )
+            rendered.append((message, _to_html(message)))
+        return rendered
+    
+    async def send_next_question(self, room: MatrixRoom, session: QuizSession):
         """Send the next question to the student"""
-        if session.current_question >= len(questions):
+        if session.current_question >= len(session.questions):
             await self.complete_quiz(room, session)
             return
         
-        question = questions[session.current_question]
-        
-        message = (
-            f"**Question {session.current_question + 1} of {len(questions)}**\n\n"
-            f"❓ {question.text}\n\n"
-            f"{chr(10).join(question.options)}\n\n"
-            "💡 Type your answer (A, B, C, or D)"
-        )
-        
-        await self.send_message(room, message)
+        plain, html = session.rendered[session.current_question]
+        await self.send_prerendered(room, plain, html)
     
-    async def handle_quiz_answer(self, room: MatrixRoom, event: Event):
+    async def handle_quiz_answer(self, room: MatrixRoom, event: Event, stripped: str):
         """Handle student's answer to quiz question"""
         session = self.active_sessions.get(room.room_id)
         if not session:
             return
         
-        answer = event.body.strip().upper()
-        
-        # Validate answer format
-        if answer not in ['A', 'B', 'C', 'D']:
+        # Validate answer format (a single letter, so check length first)
+        if len(stripped) != 1 or stripped not in _VALID_ANSWERS:
             await self.send_message(room, "⚠️ Please answer with A, B, C, or D")
             return
         
-        # Store answer
-        question_key = f"q{session.current_question + 1}"
-        session.answers[question_key] = answer
+        answer = stripped.upper()
         
-        # Move to next question
-        session.current_question += 1
+        # The lock only marks that an answer is in progress. An answer that
+        # arrives meanwhile was sent before the next question was shown (for
+        # example a double tap), so it is deliberately dropped, not queued
+        if session.lock.locked():
+            logger.debug("Dropped answer %s from %s in %s: previous answer still in progress",
+                         answer, event.sender, room.room_id)
+            return
         
-        # Get quiz questions and continue
-        try:
-            async with MoodleClient(self.moodle_server, self.moodle_token) as moodle:
-                questions = await moodle.get_quiz_questions(session.quiz_id)
+        async with session.lock:
+            # Store answer
+            question_key = f"q{session.current_question + 1}"
+            session.answers[question_key] = answer
             
-            await self.send_message(room, f"✅ Answer recorded: {answer}")
-            await self.send_next_question(room, session, questions)
+            # Move to next question
+            session.current_question += 1
             
-        except Exception as e:
-            logger.error(f"Error processing answer: {e}")
-            await self.send_message(room, f"❌ Error processing answer: {e}")
+            # Continue with the questions loaded at quiz start
+            try:
+                await self.send_message(room, f"✅ Answer recorded: {answer}")
+                await self.send_next_question(room, session)
+            
+            except Exception as e:
+                logger.error("Error processing answer: %s", e)
+                await self.send_message(room, f"❌ Error processing answer: {e}")
     
     async def complete_quiz(self, room: MatrixRoom, session: QuizSession):
         """Complete the quiz and submit to Moodle"""
+        # The quiz is over once the last answer is in, so free the room for
+        # discussion before talking to Moodle
+        self.active_sessions.pop(room.room_id, None)
+        
         try:
-            # Submit to Moodle
-            async with MoodleClient(self.moodle_server, self.moodle_token) as moodle:
-                result = await moodle.submit_quiz_attempt(
-                    session.quiz_id,
-                    session.student_id,
-                    session.answers
-                )
-            
-            # Send completion message
-            await self.send_message(room, 
-                f"🎉 **Quiz Completed!**\n\n"
-                f"📝 Questions answered: {len(session.answers)}\n"
-                f"⏰ Time taken: {datetime.now() - session.started_at}\n"
-                f"✅ Submitted to Moodle successfully!\n\n"
-                f"💬 This room is now available for discussion with your teacher.\n"
-                f"Feel free to ask questions about the quiz content!"
+            # Submit to Moodle while the completion message is sent, so the
+            # student doesn't wait on Moodle; a failure is reported afterwards
+            result, _ = await asyncio.gather(
+                self._submit_quiz(session),
+                self.send_message(room, 
+                    f"🎉 **Quiz Completed!**\n\n"
+                    f"📝 Questions answered: {len(session.answers)}\n"
+                    f"⏰ Time taken: {int(time.monotonic() - session.started_at)}s\n"
+                    f"📤 Your answers are being submitted to Moodle.\n\n"
+                    f"💬 This room is now available for discussion with your teacher.\n"
+                    f"Feel free to ask questions about the quiz content!"
+                ),
+                return_exceptions=True
             )
-            
-            # Remove from active sessions
-            del self.active_sessions[room.room_id]
+            if isinstance(result, Exception):
+                raise result
             
             # Notify teacher (would implement course room notification)
-            logger.info(f"Quiz {session.quiz_id} completed by {session.student_id}")
+            logger.info("Quiz %s completed by %s", session.quiz_id, session.student_id)
             
         except Exception as e:
-            logger.error(f"Error completing quiz: {e}")
-            await self.send_message(room, f"❌ Error submitting quiz: {e}")
+            # Keep the answers in the log so they can be entered by hand
+            logger.error("Error submitting quiz %s for %s with answers %s: %s",
+                         session.quiz_id, session.student_id, session.answers, e)
+            await self.send_message(room,
+                f"❌ Your answers could not be submitted to Moodle: {e}\n"
+                "They have been saved by the bot - please let your teacher know."
+            )
+    
+    async def _submit_quiz(self, session: QuizSession) -> Dict:
+        """Submit a completed quiz to Moodle, retrying failed attempts"""
+        for attempt in range(1, _SUBMIT_ATTEMPTS + 1):
+            try:
+                return await self.moodle.submit_quiz_attempt(
+                    session.quiz_id,
+                    session.student_id,
+                    session.answers
+                )
+            except Exception as e:
+                if attempt == _SUBMIT_ATTEMPTS:
+                    raise
+                logger.warning("Submitting quiz %s for %s failed (attempt %d): %s",
+                               session.quiz_id, session.student_id, attempt, e)
+                await asyncio.sleep(2 ** attempt)
     
-    async def handle_help_request(self, room: MatrixRoom, event: Event):
+    async def handle_help_request(self, room: MatrixRoom, event: Event, stripped: str):
         """Handle student help request"""
-        await self.send_message(room, 
-            "🆘 **Help Request Sent!**\n\n"
-            "Your teacher has been notified and will join this room shortly.\n"
-            "In the meantime, you can:\n"
-            "• Continue with the quiz\n"  
-            "• Review the question carefully\n"
-            "• Think about what you already know about this topic"
-        )
+        await self.send_prerendered(room, _HELP_REQUEST_PLAIN, _HELP_REQUEST_HTML)
         
         # Notify teacher in course room (implementation needed)
-        logger.info(f"Help request from {event.sender} in {room.room_id}")
+        logger.info("Help request from %s in %s", event.sender, room.room_id)
     
-    async def handle_general_message(self, room: MatrixRoom, event: Event):
+    async def handle_general_message(self, room: MatrixRoom, event: Event, stripped: str):
         """Handle general messages"""
-        if any(word in event.body.lower() for word in ['hello', 'hi', 'hey']):
-            await self.send_message(room,
-                "👋 Hello! I'm the Quiz Bot.\n\n"
-                "📚 Type `!quiz` to see available commands\n"
-                "🆘 Type `help` if you need assistance"
-            )
+        if _GREETING_RE.search(stripped):
+            await self.send_prerendered(room, _GREETING_PLAIN, _GREETING_HTML)
     
     async def send_message(self, room: MatrixRoom, message: str):
         """Send a message to a Matrix room"""
+        # Only line breaks need HTML; a single-line message is sent as plain text
+        if '\n' in message:
+            await self.send_prerendered(room, message, _to_html(message))
+        else:
+            await self.send_prerendered(room, message)
+    
+    async def send_prerendered(self, room: MatrixRoom, plain: str, html: Optional[str] = None):
+        """Send a message whose HTML body has already been rendered"""
+        if html is None:
+            content = self._msg_template_plain.copy()
+        else:
+            content = self._msg_template_html.copy()
+            content["formatted_body"] = html
+        content["body"] = plain
+        
         try:
             await self.client.room_send(
                 room_id=room.room_id,
                 message_type="m.room.message",
-                content={
-                    "msgtype": "m.text",
-                    "body": message,
-                    "format": "org.matrix.custom.html",
-                    "formatted_body": message.replace('\n', '<br/>')
-                }
+                content=content
             )
         except Exception as e:
-            logger.error(f"Error sending message: {e}")
+            logger.error("Error sending message: %s", e)
 
 async def main():
     """Main entry point"""
@@ -387,10 +564,20 @@ async def main():
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.error(f"Bot error: {e}")
+        logger.error("Bot error: %s", e)
     finally:
+        if bot._gc_task:
+            bot._gc_task.cancel()
+            try:
+                await bot._gc_task
+            except asyncio.CancelledError:
+                pass
+        if bot.moodle:
+            await bot.moodle.__aexit__(None, None, None)
         if bot.client:
             await bot.client.close()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())